@@ -13,11 +13,18 @@ from __future__ import annotations
 import asyncio
 import io
 import logging
+import os
 import re
+import shutil
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import TYPE_CHECKING
+from pathlib import Path
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Awaitable, Mapping, TypeVar
 
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import BotCommand, Update, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.constants import ChatAction
 from telegram.ext import (
     CommandHandler,
     ContextTypes,
@@ -35,10 +42,29 @@ from .storage import Storage
 from .strava_handlers import StravaHandlers, init_strava_handlers
 
 if TYPE_CHECKING:
-    from telegram import PhotoSize
+    from telegram import File, PhotoSize
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# 匹配 #标签（支持中文）
+# 安装了 google-re2 时使用线性时间的 DFA 引擎；RE2 的 \w 只匹配 ASCII，
+# 所以用 Unicode 字符类展开，保持与 Python re 的 \w 语义一致
+try:
+    import re2
+
+    _TAG_RE = re2.compile(r"#([\p{L}\p{N}_\x{4e00}-\x{9fa5}]+)")
+except ImportError:
+    _TAG_RE = re.compile(r"#([\w\u4e00-\u9fa5]+)")
+
+# 城市中文名映射
+_CITY_CN: Mapping[str, str] = MappingProxyType({
+    'Shanghai': '上海', 'Beijing': '北京', 'Hangzhou': '杭州',
+    'Shenzhen': '深圳', 'Chengdu': '成都', 'Guangzhou': '广州',
+    'Puer': '普洱', 'Hong Kong': '香港',
+})
+
 
 def extract_tags(text: str, exclude_label: str | None = None) -> list[str]:
     """
@@ -51,14 +77,19 @@ def extract_tags(text: str, exclude_label: str | None = None) -> list[str]:
     Returns:
         标签列表（去重）
     """
-    # 匹配 #标签（支持中文）
-    pattern = r"#([\w\u4e00-\u9fa5]+)"
-    matches = re.findall(pattern, text)
-
-    # 去重 + 过滤掉指定标签
-    tags = list(dict.fromkeys(matches))
-    if exclude_label:
-        tags = [t for t in tags if t != exclude_label]
+    # 大多数消息不含标签，没有 # 时直接跳过正则
+    if "#" not in text:
+        return []
+
+    # 一次遍历完成去重（保持顺序）+ 过滤掉指定标签
+    seen: set[str] = set()
+    tags: list[str] = []
+    for m in _TAG_RE.finditer(text):
+        tag = m.group(1)
+        if tag == exclude_label or tag in seen:
+            continue
+        seen.add(tag)
+        tags.append(tag)
 
     return tags
 
@@ -66,14 +97,37 @@ def extract_tags(text: str, exclude_label: str | None = None) -> list[str]:
 class BotHandlers:
     """Telegram Bot 处理器集合"""
 
+    # 长时间操作时重发“正在输入”状态的间隔（秒）
+    TYPING_INTERVAL = 4.5
+    # get_file 结果缓存的容量和有效期（Telegram 下载链接至少保证 1 小时有效）
+    FILE_CACHE_SIZE = 256
+    FILE_CACHE_TTL = 50 * 60
+
     def __init__(self, config: Config, github: GitHubClient):
         self.config = config
         self.github = github
 
         # 初始化存储和服务
+        # Storage 与 DiaryScheduler 共用，调度器在事件循环线程上访问它，
+        # 所以存储调用同样在事件循环线程上同步执行，只有 GitHub 请求放进线程
         self.storage = Storage()
         self.diary_service = DiaryService(self.storage, config, github)
         self.scheduler = DiaryScheduler(self.diary_service)
+
+        # 用户配置缓存（user_id -> config），写入时失效
+        self._user_config_cache: dict[int, dict] = {}
+
+        # 白名单转成 frozenset，权限检查为 O(1)
+        self._allowed_user_ids = frozenset(int(uid) for uid in config.allowed_user_ids or ())
+
+        # .env 文件路径（/config groq 修改时使用）
+        self._env_path = (Path.cwd() / ".munin" / ".env").resolve()
+
+        # get_handlers() 的缓存
+        self._handlers: list | None = None
+
+        # file_id -> (过期时间, File)，按最近使用排序的 LRU 缓存
+        self._file_cache: OrderedDict[str, tuple[float, File]] = OrderedDict()
         
         # 初始化 Strava handlers
         self.strava_handlers = init_strava_handlers(
@@ -85,7 +139,6 @@ class BotHandlers:
         """用于 Strava 调度器发送消息的辅助函数"""
         # 需要通过 application.bot 发送
         # 这里先记录日志，实际发送在 handlers 中处理
-        from telegram.error import TelegramError
         try:
             # 尝试通过 job_queue 或外部方式获取 bot
             # 这是一个简化实现
@@ -102,20 +155,22 @@ class BotHandlers:
         await self.strava_handlers.start_scheduler()
 
     def get_handlers(self):
-        """获取所有处理器"""
-        handlers = [
-            CommandHandler("config", self.handle_config),
-            CommandHandler("end", self.handle_end),
-            CommandHandler("restart", self.handle_restart),
-            CommandHandler("start", self.handle_start),
-            CommandHandler("help", self.handle_help),
-            CommandHandler("reload", self.handle_reload),
-            TelegramMessageHandler(filters.LOCATION, self.handle_location),
-            TelegramMessageHandler(filters.TEXT | filters.PHOTO, self.handle_message),
-        ]
-        # 添加 Strava 命令处理器
-        handlers.extend(self.strava_handlers.get_handlers())
-        return handlers
+        """获取所有处理器（首次调用时构建，之后复用同一列表）"""
+        if self._handlers is None:
+            handlers = [
+                CommandHandler("config", self.handle_config),
+                CommandHandler("end", self.handle_end),
+                CommandHandler("restart", self.handle_restart),
+                CommandHandler("start", self.handle_start),
+                CommandHandler("help", self.handle_help),
+                CommandHandler("reload", self.handle_reload),
+                TelegramMessageHandler(filters.LOCATION, self.handle_location),
+                TelegramMessageHandler(filters.TEXT | filters.PHOTO, self.handle_message),
+            ]
+            # 添加 Strava 命令处理器
+            handlers.extend(self.strava_handlers.get_handlers())
+            self._handlers = handlers
+        return self._handlers
 
     async def handle_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """处理 /start 命令"""
@@ -183,7 +238,7 @@ class BotHandlers:
         args = context.args
         if not args:
             # 显示当前配置
-            config = self.storage.get_user_config(user_id)
+            config = self._get_user_config(user_id)
             time_status = "开启" if config.get("show_entry_time", True) else "关闭"
             time_format = config.get("entry_time_format", "%H:%M")
             groq_key = self.config.groq_api_key
@@ -218,10 +273,10 @@ class BotHandlers:
         if key == "time" and len(args) >= 2:
             value = args[1].lower()
             if value in ("on", "true", "1"):
-                self.storage.set_user_config(user_id, "show_entry_time", 1)
+                self._set_user_config(user_id, "show_entry_time", 1)
                 await update.message.reply_text("✅ 已开启时间显示")
             elif value in ("off", "false", "0"):
-                self.storage.set_user_config(user_id, "show_entry_time", 0)
+                self._set_user_config(user_id, "show_entry_time", 0)
                 await update.message.reply_text("✅ 已关闭时间显示")
             else:
                 await update.message.reply_text("❌ 用法: /config time on|off")
@@ -229,10 +284,10 @@ class BotHandlers:
         elif key == "format" and len(args) >= 2:
             value = args[1].lower()
             if value == "24h":
-                self.storage.set_user_config(user_id, "entry_time_format", "%H:%M")
+                self._set_user_config(user_id, "entry_time_format", "%H:%M")
                 await update.message.reply_text("✅ 已设置为24小时制 (16:30)")
             elif value == "12h":
-                self.storage.set_user_config(user_id, "entry_time_format", "%I:%M %p")
+                self._set_user_config(user_id, "entry_time_format", "%I:%M %p")
                 await update.message.reply_text("✅ 已设置为12小时制 (04:30 PM)")
             else:
                 await update.message.reply_text("❌ 用法: /config format 24h|12h")
@@ -323,29 +378,36 @@ class BotHandlers:
     async def _update_env_file(self, key: str, value: str) -> bool:
         """更新 .env 文件中的配置项"""
         try:
-            from pathlib import Path
-            env_path = Path.cwd() / ".munin" / ".env"
-            if not env_path.exists():
+            try:
+                content = self._env_path.read_text(encoding="utf-8")
+            except FileNotFoundError:
                 return False
 
-            content = env_path.read_text(encoding="utf-8")
-            lines = content.split("\n")
-
-            # 查找并替换或添加配置项
-            found = False
-            new_lines = []
-            for line in lines:
-                if line.startswith(f"{key}="):
-                    if value:
-                        new_lines.append(f"{key}={value}")
-                    found = True
-                else:
-                    new_lines.append(line)
-
-            if not found and value:
-                new_lines.append(f"{key}={value}")
-
-            env_path.write_text("\n".join(new_lines), encoding="utf-8")
+            # 一次正则替换所有 KEY= 行；value 为空时连同换行一起删除
+            if value:
+                pattern = re.compile(rf"^{re.escape(key)}=.*$", re.M)
+                content, count = pattern.subn(lambda _: f"{key}={value}", content)
+                if count == 0:
+                    if content and not content.endswith("\n"):
+                        content += "\n"
+                    content += f"{key}={value}\n"
+            else:
+                content = re.sub(rf"^{re.escape(key)}=.*\n?", "", content, flags=re.M)
+
+            # 先写临时文件（fsync 落盘）再替换，避免写到一半时 .env 损坏；
+            # 临时文件以 0600 创建，并沿用原文件权限，避免密钥对其他用户可读
+            tmp_path = self._env_path.with_name(self._env_path.name + ".tmp")
+            try:
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                shutil.copymode(self._env_path, tmp_path)
+                os.replace(tmp_path, self._env_path)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
             return True
         except Exception as e:
             logger.exception(f"更新 .env 文件失败: {e}")
@@ -361,7 +423,9 @@ class BotHandlers:
             return
 
         try:
-            await update.message.reply_text("🔄 正在合并今天的日记...")
+            # 用“正在输入”状态代替一条进度消息，减少一次 API 调用
+            chat_id = update.effective_chat.id
+            await context.bot.send_chat_action(chat_id, ChatAction.TYPING)
 
             # 先上传所有未上传的图片
             today = self.diary_service.get_or_create_today(user_id)
@@ -371,8 +435,10 @@ class BotHandlers:
                 await update.message.reply_text("📭 今天还没有日记内容")
                 return
 
-            # 强制合并
-            issue_url = await self.scheduler.force_merge_today(user_id)
+            # 强制合并（期间持续显示“正在输入”）
+            issue_url = await self._with_typing(
+                context, chat_id, self.scheduler.force_merge_today(user_id)
+            )
 
             if issue_url:
                 await update.message.reply_text(f"✅ 日记已合并\n\n🔗 {issue_url}")
@@ -383,6 +449,28 @@ class BotHandlers:
             logger.exception("手动合并失败")
             await update.message.reply_text(f"❌ 出错了: {e}")
 
+    async def _with_typing(
+        self,
+        context: ContextTypes.DEFAULT_TYPE,
+        chat_id: int,
+        coro: Awaitable[T],
+    ) -> T:
+        """执行 coro，期间每隔几秒重发“正在输入”状态（Telegram 约 5 秒后自动消失）"""
+
+        async def keep_typing() -> None:
+            while True:
+                await asyncio.sleep(self.TYPING_INTERVAL)
+                try:
+                    await context.bot.send_chat_action(chat_id, ChatAction.TYPING)
+                except Exception as e:
+                    logger.warning(f"发送输入状态失败: {e}")
+
+        typing_task = asyncio.create_task(keep_typing())
+        try:
+            return await coro
+        finally:
+            typing_task.cancel()
+
     async def handle_restart(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """处理 /restart 命令 - 重启 Bot"""
         user_id = update.effective_user.id
@@ -410,8 +498,6 @@ class BotHandlers:
             return
         
         try:
-            from telegram import BotCommand
-            
             # 重新设置命令菜单
             commands = [
                 BotCommand("start", "开始使用日记机器人"),
@@ -447,22 +533,16 @@ class BotHandlers:
         lat = location.latitude
         lng = location.longitude
         
-        # 导入位置服务
+        # 导入位置服务（bot/sync 依赖运行时的 sys.path，保持延迟导入）
         try:
             from sync.location_service import get_nearest_city
             city = get_nearest_city(lat, lng)
             
             if city:
                 # 保存到用户配置
-                self.storage.set_user_config(user_id, "weather_location", city)
+                self._set_user_config(user_id, "weather_location", city)
                 
-                # 城市中文名映射
-                city_names = {
-                    'Shanghai': '上海', 'Beijing': '北京', 'Hangzhou': '杭州',
-                    'Shenzhen': '深圳', 'Chengdu': '成都', 'Guangzhou': '广州',
-                    'Puer': '普洱', 'Hong Kong': '香港',
-                }
-                city_cn = city_names.get(city, city)
+                city_cn = _CITY_CN.get(city, city)
                 
                 await update.message.reply_text(
                     f"✅ 已保存位置：{city_cn}\n"
@@ -476,7 +556,7 @@ class BotHandlers:
                     "已保存坐标，将使用默认天气。",
                     reply_markup=ReplyKeyboardRemove()
                 )
-                self.storage.set_user_config(user_id, "weather_location", f"{lat},{lng}")
+                self._set_user_config(user_id, "weather_location", f"{lat},{lng}")
                 
         except Exception as e:
             logger.exception("处理位置消息失败")
@@ -543,11 +623,22 @@ class BotHandlers:
             logger.exception("处理消息失败")
             await update.message.reply_text(f"❌ 出错了: {e}")
 
+    def _get_user_config(self, user_id: int) -> dict:
+        """读取用户配置（带内存缓存）"""
+        config = self._user_config_cache.get(user_id)
+        if config is None:
+            config = self.storage.get_user_config(user_id)
+            self._user_config_cache[user_id] = config
+        return config
+
+    def _set_user_config(self, user_id: int, key: str, value) -> None:
+        """写入用户配置，并使缓存失效"""
+        self.storage.set_user_config(user_id, key, value)
+        self._user_config_cache.pop(user_id, None)
+
     def _check_permission(self, user_id: int) -> bool:
         """检查用户权限"""
-        if not self.config.allowed_user_ids:
-            return True
-        return user_id in self.config.allowed_user_ids
+        return not self._allowed_user_ids or user_id in self._allowed_user_ids
 
     def _extract_tags(self, text: str) -> list[str]:
         """从文本中提取 #标签"""
@@ -561,25 +652,56 @@ class BotHandlers:
         """
         上传图片到 GitHub 仓库，返回图片 URL 列表。
         """
-        refs: list[str] = []
+        if not photos:
+            return []
 
-        # Telegram 的 message.photo 是同一张图的不同尺寸，取最大尺寸
-        largest = max(photos, key=lambda p: p.file_size or 0)
+        # Telegram 的 message.photo 是同一张图的不同尺寸，按尺寸升序排列，最后一个最大
+        largest = photos[-1]
 
+        # 日期目录和时间直接从 datetime 属性拼接
+        now = datetime.now(tz=self.config.timezone)
+        image_dir = f"{self.config.image_dir}/{now.year:04d}/{now.month:02d}/{now.day:02d}"
+        time_str = f"{now.hour:02d}{now.minute:02d}{now.second:02d}"
+
+        ref = await self._upload_photo(largest, image_dir, time_str, context)
+        return [ref] if ref else []
+
+    async def _get_file(self, file_id: str, context: ContextTypes.DEFAULT_TYPE) -> File:
+        """解析 file_id 为可下载的 File，重复发送的同一张图复用之前的结果"""
+        now = time.monotonic()
+        cached = self._file_cache.get(file_id)
+        if cached and cached[0] > now:
+            self._file_cache.move_to_end(file_id)
+            return cached[1]
+
+        file = await context.bot.get_file(file_id)
+        self._file_cache[file_id] = (now + self.FILE_CACHE_TTL, file)
+        self._file_cache.move_to_end(file_id)
+        while len(self._file_cache) > self.FILE_CACHE_SIZE:
+            self._file_cache.popitem(last=False)
+        return file
+
+    async def _upload_photo(
+        self,
+        photo: PhotoSize,
+        image_dir: str,
+        time_str: str,
+        context: ContextTypes.DEFAULT_TYPE,
+    ) -> str | None:
+        """下载单张图片并上传到 GitHub 仓库，返回 Markdown 图片引用"""
         # 下载图片
-        file = await context.bot.get_file(largest.file_id)
+        file = await self._get_file(photo.file_id, context)
         bio = io.BytesIO()
         await file.download_to_memory(bio)
         content = bio.getvalue()
 
         # 生成文件路径
-        now = datetime.now(tz=self.config.timezone)
-        date_path = now.strftime("%Y/%m/%d")
-        filename = f"photo_{now.strftime('%H%M%S')}_{largest.file_id[-8:]}.jpg"
-        file_path = f"{self.config.image_dir}/{date_path}/{filename}"
+        filename = f"photo_{time_str}_{photo.file_id[-8:]}.jpg"
+        file_path = f"{image_dir}/{filename}"
 
-        # 上传
-        result = self.github.upload_file(
+        # 上传（GitHubClient 是同步的，放到线程里执行，避免阻塞事件循环）
+        result = await asyncio.to_thread(
+            self.github.upload_file,
             file_path=file_path,
             content=content,
             commit_message=f"Add image {filename}",
@@ -589,9 +711,8 @@ class BotHandlers:
         if result and "content" in result:
             # 构建 raw.githubusercontent.com URL
             raw_url = f"https://raw.githubusercontent.com/{self.config.github_owner}/{self.config.github_repo}/{self.config.branch}/{file_path}"
-            refs.append(f"![]({raw_url})")
-
-        return refs
+            return f"![]({raw_url})"
+        return None
 
 
 # 向后兼容的 MessageHandler 类（单消息处理，不集成日记）
@@ -601,11 +722,12 @@ class MessageHandler:
     def __init__(self, config: Config, github: GitHubClient):
         self.config = config
         self.github = github
+        self._allowed_user_ids = frozenset(int(uid) for uid in config.allowed_user_ids or ())
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """处理收到的消息（向后兼容）"""
         user_id = update.effective_user.id
-        if self.config.allowed_user_ids and user_id not in self.config.allowed_user_ids:
+        if self._allowed_user_ids and user_id not in self._allowed_user_ids:
             logger.warning(f"拒绝未授权用户: {user_id}")
             await update.message.reply_text("⚠️ 你没有权限使用这个 bot")
             return
@@ -625,7 +747,8 @@ class MessageHandler:
 
             issue_title, issue_body = self._build_issue_content(text, image_refs, tags)
 
-            issue = self.github.create_issue(
+            issue = await asyncio.to_thread(
+                self.github.create_issue,
                 title=issue_title,
                 body=issue_body,
                 labels=tags,
@@ -652,18 +775,22 @@ class MessageHandler:
     ) -> list[str]:
         """上传图片"""
         refs: list[str] = []
-        largest = max(photos, key=lambda p: p.file_size or 0)
+        if not photos:
+            return refs
+        largest = photos[-1]
         file = await context.bot.get_file(largest.file_id)
         bio = io.BytesIO()
         await file.download_to_memory(bio)
         content = bio.getvalue()
 
         now = datetime.now(tz=self.config.timezone)
-        date_path = now.strftime("%Y/%m/%d")
-        filename = f"photo_{now.strftime('%H%M%S')}_{largest.file_id[-8:]}.jpg"
+        date_path = f"{now.year:04d}/{now.month:02d}/{now.day:02d}"
+        time_str = f"{now.hour:02d}{now.minute:02d}{now.second:02d}"
+        filename = f"photo_{time_str}_{largest.file_id[-8:]}.jpg"
         file_path = f"{self.config.image_dir}/{date_path}/{filename}"
 
-        self.github.upload_file(
+        await asyncio.to_thread(
+            self.github.upload_file,
             file_path=file_path,
             content=content,
             commit_message=f"Add image {filename}",
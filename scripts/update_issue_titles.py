@@ -35,22 +35,61 @@ token = os.getenv('GITHUB_TOKEN')
 owner = os.getenv('GITHUB_OWNER', 'zchan0')
 repo = os.getenv('GITHUB_REPO', 'Raven')
 
-headers = {
-    "Authorization": f"token {token}",
-    "Accept": "application/vnd.github.v3+json",
+graphql_url = "https://api.github.com/graphql"
+
+# 复用同一个 TLS 连接发送查询和 mutation
+session = requests.Session()
+session.headers["Authorization"] = f"bearer {token}"
+
+
+def graphql(query, variables):
+    """发送 GraphQL 请求，返回 (data, 错误信息)；HTTP 错误和 GraphQL errors 统一处理"""
+    response = session.post(graphql_url, json={"query": query, "variables": variables})
+    if response.status_code != 200:
+        return {}, f"{response.status_code} - {response.text}"
+    result = response.json()
+    errors = result.get("errors")
+    return result.get("data") or {}, (f"{response.status_code} - {errors}" if errors else None)
+
+
+new_titles = {
+    num: get_diary_header(datetime.strptime(date_str, "%Y-%m-%d"), "Shanghai")
+    for num, date_str in issues
 }
 
-for num, date_str in issues:
-    date = datetime.strptime(date_str, "%Y-%m-%d")
-    new_title = get_diary_header(date, "Shanghai")
-    
-    url = f"https://api.github.com/repos/{owner}/{repo}/issues/{num}"
-    
-    response = requests.patch(url, headers=headers, json={"title": new_title})
-    
-    if response.status_code == 200:
-        print(f"✅ Issue #{num} 标题已更新: {new_title}")
+# 一次查询拿到所有 Issue 的 node ID（GraphQL mutation 需要 node ID 而不是编号）
+id_query = "query($owner: String!, $repo: String!) { repository(owner: $owner, name: $repo) { %s } }" % " ".join(
+    f"i{num}: issue(number: {num}) {{ id }}" for num in new_titles
+)
+data, error = graphql(id_query, {"owner": owner, "repo": repo})
+repository = data.get("repository") or {}
+
+# 把所有 updateIssue 合并成一个带别名的 mutation，只发一次请求
+node_ids = {}
+for num in new_titles:
+    node = repository.get(f"i{num}")
+    if node:
+        node_ids[num] = node["id"]
     else:
-        print(f"❌ Issue #{num} 更新失败: {response.status_code} - {response.text}")
+        print(f"❌ Issue #{num} 查询失败: {error or '不存在'}")
+
+params = []
+fields = []
+variables = {}
+for num, node_id in node_ids.items():
+    params.append(f"$id{num}: ID!, $title{num}: String!")
+    fields.append(f"m{num}: updateIssue(input: {{id: $id{num}, title: $title{num}}}) {{ issue {{ number }} }}")
+    variables[f"id{num}"] = node_id
+    variables[f"title{num}"] = new_titles[num]
+
+if fields:
+    mutation = f"mutation({', '.join(params)}) {{ {' '.join(fields)} }}"
+    data, error = graphql(mutation, variables)
+
+    for num in node_ids:
+        if data.get(f"m{num}"):
+            print(f"✅ Issue #{num} 标题已更新: {new_titles[num]}")
+        else:
+            print(f"❌ Issue #{num} 更新失败: {error or '未返回结果'}")
 
 print("\n=== 完成 ===")